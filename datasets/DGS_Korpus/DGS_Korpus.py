@@ -2,22 +2,23 @@
 # coding: utf-8
 
 import argparse
+import functools
 import logging
 import os
 import shutil
 import sys
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
-import ffmpeg
-import matplotlib.pyplot as plt
-import numpy as np
 import pandas as pd
 import requests
-import seaborn as sns
+import urllib3
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
-from wordcloud import WordCloud
+from urllib3.util.retry import Retry
 
-tqdm.pandas()
+thread_local = threading.local()
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
 
 def parse_arguments():
@@ -29,9 +30,11 @@ def parse_arguments():
     parser.add_argument('--downloadable_url_path', type=str, default='https://www.sign-lang.uni-hamburg.de/meinedgs/', help='Base path for downloadable URLs')
     parser.add_argument('--ca_cert', type=lambda x: x if x.lower() not in ['true', 'false'] else x.lower() == 'true', default=True, help='Path to the CA certificate')  # '/usr/local/share/ca-certificates/Fortinet_CA_SSL-1.crt'
     parser.add_argument('--dgs_path', type=str, default='/home/marcel/Documents/data/DGS_Korpus', help='Path where you want to store the DGS Korpus')
-    parser.add_argument('--csv_filename', type=str, default='dgs_korpus_paths.csv', help='Name of the CSV file to save paths data')
+    parser.add_argument('--csv_filename', type=str, default='dgs_korpus_paths.csv.zst', help='Name of the CSV file to save paths data, compressed according to its extension')
     parser.add_argument('--csv_filepath', type=str, default=None, help='Absolute path to the CSV file to save paths data')
     parser.add_argument('--action', type=str, choices=['download', 'analyse', 'both'], default='both', help='Action to perform: download, analyse, or both')
+    parser.add_argument('--download_workers', type=int, default=32, help='Number of files downloaded concurrently')
+    parser.add_argument('--metadata_workers', type=int, default=None, help='Number of processes extracting video metadata (defaults to the number of CPUs)')
     return parser.parse_args()
 
 def scrape_table(url, ca_cert, downloadable_url_path):
@@ -47,44 +50,61 @@ def scrape_table(url, ca_cert, downloadable_url_path):
     - df: pd.DataFrame, the scraped data as a DataFrame.
     """
     response = requests.get(url, verify=ca_cert)
-    soup = BeautifulSoup(response.content, 'html.parser')
+    soup = BeautifulSoup(response.content, 'lxml')
     table = soup.find('table')
-    data = []
 
     for i, row in enumerate(table.find_all('tr')):
         if i == 0:
             header_cells = row.find_all("th")
             header = [c.text.strip() for c in header_cells]
+            # Build the DataFrame column by column instead of from a list of row dicts
+            columns = {h: [] for h in header}
 
         cells = row.find_all('td')
         if cells:
-            transcript = cells[0].text.strip()
-            age_group = cells[1].text.strip()
-            format_type = cells[2].text.strip()
             topics = [topic.text.strip() for topic in cells[3].find_all('a')]
-            text_dict = {
-                'Transcript': transcript,
-                'Age Group': age_group,
-                'Format': format_type,
-                'Topics': ', '.join(topics),
-            }
-
-            urls_dict = {}
-            for col_header, cell in zip(header[4:], cells[4:]):
-                links = [downloadable_url_path + link.get('href')[3:] for link in cell.find_all('a') if link.get('href')]
+            columns['Transcript'].append(cells[0].text.strip())
+            columns['Age Group'].append(cells[1].text.strip())
+            columns['Format'].append(cells[2].text.strip())
+            columns['Topics'].append(', '.join(topics))
+
+            # Rows with fewer cells than the header get None for the missing columns
+            for j, col_header in enumerate(header[4:], start=4):
+                links = []
+                if j < len(cells):
+                    links = [downloadable_url_path + link.get('href')[3:] for link in cells[j].find_all('a') if link.get('href')]
                 if len(links) == 1:
-                    urls_dict[col_header] = links[0]
+                    columns[col_header].append(links[0])
                 elif len(links) > 1:
-                    urls_dict[col_header] = links
+                    columns[col_header].append(links)
                 else:
-                    urls_dict[col_header] = None
+                    columns[col_header].append(None)
 
-            merged_dict = {**text_dict, **urls_dict}
-            data.append(merged_dict)
-
-    df = pd.DataFrame(data, columns=header)
+    df = pd.DataFrame(columns, columns=header)
     return df
 
+def get_session(max_retries=3):
+    """
+    Get the requests session of the current thread, creating it on first use.
+
+    The session keeps the connections to the server alive between downloads. Each thread
+    gets its own session as requests does not guarantee that sessions are thread-safe.
+
+    Parameters:
+    - max_retries: int, maximum number of download attempts.
+
+    Returns:
+    - requests.Session, the session of the current thread.
+    """
+    session = getattr(thread_local, 'session', None)
+    if session is None:
+        retries = Retry(total=max_retries - 1, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(max_retries=retries))
+        session.mount('https://', HTTPAdapter(max_retries=retries))
+        thread_local.session = session
+    return session
+
 def download_file(url, save_path, ca_cert, max_retries=3):
     """
     Download a file from the given URL with retry logic.
@@ -98,19 +118,20 @@ def download_file(url, save_path, ca_cert, max_retries=3):
     Returns:
     - str, the path to the saved file or None if the download failed.
     """
+    # The session retries the connection and the response headers, a transfer that breaks while
+    # the body is streaming restarts the download here, truncating the partial file
     for attempt in range(max_retries):
         try:
-            response = requests.get(url, stream=True, verify=ca_cert)
-            response.raise_for_status()
-            with open(save_path, 'wb') as file:
-                for chunk in response.iter_content(1024):
-                    file.write(chunk)
+            with get_session(max_retries).get(url, stream=True, verify=ca_cert, timeout=30) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                with open(save_path, 'wb') as file:
+                    shutil.copyfileobj(response.raw, file, length=1024 * 1024)
             return save_path
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
             logging.warning(f"Failed to download {url} (Attempt {attempt + 1}/{max_retries}): {e}")
             if attempt == max_retries - 1:
                 logging.warning(f"Url {url} could not be downloaded after {max_retries} attempts.")
-                return None
     return None
 
 def create_directory(path):
@@ -120,65 +141,118 @@ def create_directory(path):
     Parameters:
     - path: str, the path of the directory to create.
     """
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
 
-def download_file_row(row, base_dir, ca_cert, max_retries=3):
+def download_file_row(name, row, base_dir, ca_cert, executor, max_retries=3):
     """
-    Download files for a given row of the DataFrame.
+    Submit the downloads of the files for a given row of the DataFrame.
 
     Parameters:
-    - row: pd.Series, a row of the DataFrame.
+    - name: str, the index of the row.
+    - row: dict, the URLs of the row by column.
     - base_dir: str, the base directory to save the files.
     - ca_cert: str or bool, the path to the CA certificate or True/False for verification.
+    - executor: concurrent.futures.Executor, the executor running the downloads.
     - max_retries: int, maximum number of download attempts.
 
     Returns:
-    - pd.Series, a series with paths of downloaded files.
+    - dict, the row directory and, per column, the future(s) of its download(s) or None.
     """
-    row_dir = os.path.join(base_dir, row.name)
+    row_dir = os.path.join(base_dir, name)
     filenames = {("Paths", "base_dir"): row_dir}
     create_directory(row_dir)
 
-    for col in row.index:
-        url = row[col]
+    for col, url in row.items():
         if isinstance(url, str):
-            filename = os.path.basename(url)
-            filepath = os.path.join(row_dir, filename)
-            downloaded_file = download_file(url, filepath, ca_cert, max_retries)
-            filenames[("Paths", col)] = filename if downloaded_file else None
-            if not downloaded_file:
-                logging.warning(f"Url {url} could not be downloaded after {max_retries} attempts.")
+            filepath = os.path.join(row_dir, os.path.basename(url))
+            filenames[("Paths", col)] = executor.submit(download_file, url, filepath, ca_cert, max_retries)
         elif isinstance(url, list):
             urls = url
-            paths = []
+            futures = []
             for url in urls:
-                filename = os.path.basename(url)
-                filepath = os.path.join(row_dir, filename)
-                downloaded_file = download_file(url, filepath, ca_cert, max_retries)
-                paths.append(filename if downloaded_file else None)
-            filenames[("Paths", col)] = paths
-            if any(file is None for file in paths):
-                logging.warning(f"Some URLs in the list {urls} could not be downloaded after {max_retries} attempts.")
-        elif url is None:
+                filepath = os.path.join(row_dir, os.path.basename(url))
+                futures.append(executor.submit(download_file, url, filepath, ca_cert, max_retries))
+            filenames[("Paths", col)] = futures
+        elif pd.isna(url):
             filenames[("Paths", col)] = None
         else:
             raise TypeError(f"URL {url} of type {type(url)}.")
-            
-    return pd.Series(filenames)
 
-def get_video_metadata(file_path):
+    return filenames
+
+def collect_file_row(filenames):
+    """
+    Wait for the downloads of a row and collect the names of the downloaded files.
+
+    Parameters:
+    - filenames: dict, the output of download_file_row.
+
+    Returns:
+    - dict, the paths of the downloaded files by column.
+    """
+    paths = {}
+    for key, value in filenames.items():
+        if isinstance(value, Future):
+            downloaded_file = value.result()
+            paths[key] = os.path.basename(downloaded_file) if downloaded_file else None
+        elif isinstance(value, list):
+            downloaded_files = [future.result() for future in value]
+            paths[key] = [os.path.basename(file) if file else None for file in downloaded_files]
+            if any(file is None for file in downloaded_files):
+                logging.warning(f"Some files of {key[1]} in {filenames[('Paths', 'base_dir')]} could not be downloaded.")
+        else:
+            paths[key] = value
+
+    return paths
+
+def probe_video(file_path, size, mtime):
+    """
+    Probe a video file with ffprobe.
+
+    The size and modification time are not used by the probe, they are part of the
+    cache key so that cached results are invalidated when the file changes.
+
+    Parameters:
+    - file_path: str, the path to the video file.
+    - size: int, the size of the video file in bytes.
+    - mtime: float, the modification time of the video file.
+
+    Returns:
+    - dict, the output of ffprobe.
+    """
+    import ffmpeg
+
+    return ffmpeg.probe(file_path)
+
+@functools.lru_cache(maxsize=None)
+def get_cached_probe(cache_dir):
+    """
+    Get probe_video with its results persisted on disk.
+
+    Parameters:
+    - cache_dir: str or None, the directory of the cache, or None to disable caching.
+
+    Returns:
+    - callable, probe_video wrapped by joblib.Memory.
+    """
+    from joblib import Memory
+
+    return Memory(cache_dir, verbose=0).cache(probe_video)
+
+def get_video_metadata(file_path, cache_dir=None):
     """
     Get metadata of a video file.
 
     Parameters:
     - file_path: str, the path to the video file.
+    - cache_dir: str or None, the directory caching the ffprobe results, or None to disable caching.
 
     Returns:
     - tuple, containing duration and dimensions (width, height) of the video or None if failed.
     """
     try:
-        probe = ffmpeg.probe(file_path)
+        stat = os.stat(file_path)
+        probe = get_cached_probe(cache_dir)(file_path, stat.st_size, stat.st_mtime)
         video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
         if video_stream is None:
             return None
@@ -192,34 +266,33 @@ def get_video_metadata(file_path):
         print(f"Error getting metadata for {file_path}: {e}")
         return None
 
-def extract_metadata(row):
+def extract_metadata(row, cache_dir=None):
     """
     Extract metadata from video files in a DataFrame row.
 
     Parameters:
-    - row: pd.Series, a row of the DataFrame.
+    - row: dict, the paths of the row by column.
+    - cache_dir: str or None, the directory caching the ffprobe results, or None to disable caching.
 
     Returns:
-    - pd.Series, a series with metadata of the videos.
+    - dict, the metadata of the videos by column.
     """
     base_dir = row['base_dir']
     video_types = ['Video A', 'Video B', 'Video Total', 'Video AB']
     metadata_dict = {}
     
     for video_type in video_types:
-        filename_col = f'{video_type}'
-        filename = row[filename_col]
-        if filename is np.nan:
-            metadata = [None, (None, None)]
-        else:
-            path = os.path.join(base_dir, filename)
-            metadata = get_video_metadata(path)
-        
+        filename = row[video_type]
+        # Videos missing from the row are left out and end up as NaN once the rows are merged
+        if not isinstance(filename, str):
+            continue
+
+        metadata = get_video_metadata(os.path.join(base_dir, filename), cache_dir)
         if metadata:
             metadata_dict[("Metadata", f'{video_type} Duration')] = metadata[0]
             metadata_dict[("Metadata", f'{video_type} Dimensions')] = metadata[1]
     
-    return pd.Series(metadata_dict)
+    return metadata_dict
 
 def seconds_to_hms(seconds):
     """
@@ -231,9 +304,9 @@ def seconds_to_hms(seconds):
     Returns:
     - str, formatted string in the form of "H hours, M minutes, S seconds".
     """
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    seconds = seconds % 60
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = int(hours), int(minutes)
     result = []
     if hours > 0:
         result.append(f"{hours} hours")
@@ -270,58 +343,72 @@ def print_video_duration_stats(df):
     print(f"Total duration: {seconds_to_hms(total_duration)}")
     
 def plot_and_save_figures(df, figures_dir):
-    plt.figure(figsize=(20, 12))
-    sns.countplot(x=df[('Data', 'Age Group')], order=df[('Data', 'Age Group')].value_counts().index)
-    plt.title('Distribution of Age Groups')
-    plt.xlabel('Age Group')
-    plt.ylabel('Count')
-    plt.savefig(os.path.join(figures_dir, "1_Distribution_of_Age_Groups.png"))
-    plt.close()
-
-    plt.figure(figsize=(20, 12))
-    sns.countplot(x=df[('Data', 'Format')], order=df[('Data', 'Format')].value_counts().index)
-    plt.title('Distribution of Formats')
-    plt.xlabel('Format')
-    plt.ylabel('Count')
-    plt.savefig(os.path.join(figures_dir, "2_Distribution_of_Formats.png"))
-    plt.close()
-
+    # The plotting stack is only imported when analysing, it is heavy and not needed to download
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from wordcloud import WordCloud
+
+    # Derive the plotted series once and share them between the figures
+    age_groups = df[('Data', 'Age Group')]
+    formats = df[('Data', 'Format')]
     topics = df[('Data', 'Topics')].str.split(', ').explode()
-    plt.figure(figsize=(20, 12))
-    sns.countplot(y=topics, order=topics.value_counts().index)
-    plt.title('Distribution of Topics')
-    plt.xlabel('Count')
-    plt.ylabel('Topic')
-    plt.savefig(os.path.join(figures_dir, "3_Distribution_of_Topics.png"))
-    plt.close()
-
-    wordcloud = WordCloud(width=800, height=400, background_color='white').generate(' '.join(topics.dropna()))
-    plt.figure(figsize=(20, 12))
-    plt.imshow(wordcloud, interpolation='bilinear')
-    plt.axis('off')
-    plt.title('Word Cloud of Topics')
-    plt.savefig(os.path.join(figures_dir, "4_Word_Cloud_of_Topics.png"))
-    plt.close()
-
-    age_groups = df[('Data', 'Age Group')].unique()
-    for age_group in age_groups:
-        age_group_topics = df[df[('Data', 'Age Group')] == age_group][('Data', 'Topics')].str.split(', ').explode()
-        wordcloud = WordCloud(width=800, height=400, background_color='white').generate(' '.join(age_group_topics.dropna()))
-
-        plt.figure(figsize=(20, 12))
-        plt.imshow(wordcloud, interpolation='bilinear')
-        plt.axis('off')
-        plt.title(f'Word Cloud for Age Group: {age_group}')
-        plt.savefig(os.path.join(figures_dir, f"5_Word_Cloud_for_Age_Group_{age_group}.png"))
-        plt.close()
-
-    plt.figure(figsize=(20, 12))
-    sns.histplot(df[('Metadata', 'Video Total Duration')], bins=30, kde=True)
-    plt.title('Distribution of Video Durations')
-    plt.xlabel('Duration (seconds)')
-    plt.ylabel('Count')
-    plt.savefig(os.path.join(figures_dir, "6_Distribution_of_Video_Durations.png"))
-    plt.close()
+    topic_counts = topics.value_counts()
+    topics_by_age_group = topics.groupby(age_groups.reindex(topics.index), sort=False)
+
+    # Draw every plot on the same figure, cleared in between
+    fig = plt.figure(figsize=(20, 12))
+
+    ax = fig.add_subplot(111)
+    sns.countplot(x=age_groups, order=age_groups.value_counts().index, ax=ax)
+    ax.set_title('Distribution of Age Groups')
+    ax.set_xlabel('Age Group')
+    ax.set_ylabel('Count')
+    fig.savefig(os.path.join(figures_dir, "1_Distribution_of_Age_Groups.png"))
+
+    fig.clf()
+    ax = fig.add_subplot(111)
+    sns.countplot(x=formats, order=formats.value_counts().index, ax=ax)
+    ax.set_title('Distribution of Formats')
+    ax.set_xlabel('Format')
+    ax.set_ylabel('Count')
+    fig.savefig(os.path.join(figures_dir, "2_Distribution_of_Formats.png"))
+
+    fig.clf()
+    ax = fig.add_subplot(111)
+    sns.countplot(y=topics, order=topic_counts.index, ax=ax)
+    ax.set_title('Distribution of Topics')
+    ax.set_xlabel('Count')
+    ax.set_ylabel('Topic')
+    fig.savefig(os.path.join(figures_dir, "3_Distribution_of_Topics.png"))
+
+    wordcloud = WordCloud(width=800, height=400, background_color='white').generate_from_frequencies(topic_counts.to_dict())
+    fig.clf()
+    ax = fig.add_subplot(111)
+    ax.imshow(wordcloud, interpolation='bilinear')
+    ax.axis('off')
+    ax.set_title('Word Cloud of Topics')
+    fig.savefig(os.path.join(figures_dir, "4_Word_Cloud_of_Topics.png"))
+
+    for age_group, age_group_topics in topics_by_age_group:
+        wordcloud = WordCloud(width=800, height=400, background_color='white').generate_from_frequencies(age_group_topics.value_counts().to_dict())
+
+        fig.clf()
+        ax = fig.add_subplot(111)
+        ax.imshow(wordcloud, interpolation='bilinear')
+        ax.axis('off')
+        ax.set_title(f'Word Cloud for Age Group: {age_group}')
+        fig.savefig(os.path.join(figures_dir, f"5_Word_Cloud_for_Age_Group_{age_group}.png"))
+
+    fig.clf()
+    ax = fig.add_subplot(111)
+    sns.histplot(df[('Metadata', 'Video Total Duration')], bins=30, kde=True, ax=ax)
+    ax.set_title('Distribution of Video Durations')
+    ax.set_xlabel('Duration (seconds)')
+    ax.set_ylabel('Count')
+    fig.savefig(os.path.join(figures_dir, "6_Distribution_of_Video_Durations.png"))
+    plt.close(fig)
     
     print(f"Saved figures at {figures_dir}")
 
@@ -364,8 +451,19 @@ def download_data(args):
         ('URLs', 'OpenPose'),
     ])
 
-    tqdm.pandas(desc="Downloading DGS Korpus")
-    df_paths = df["URLs"].progress_apply(download_file_row, args=(args.dgs_path, args.ca_cert), axis=1)
+    # Submit every file of the corpus up front so that the downloads overlap instead of running row by row
+    with ThreadPoolExecutor(max_workers=args.download_workers) as executor:
+        try:
+            # Plain dicts per row are much cheaper to build and iterate than Series
+            rows = {name: download_file_row(name, row, args.dgs_path, args.ca_cert, executor) for name, row in df["URLs"].to_dict("index").items()}
+            df_paths = pd.DataFrame.from_dict(
+                {name: collect_file_row(filenames) for name, filenames in tqdm(rows.items(), desc="Downloading DGS Korpus")},
+                orient='index',
+            )
+        except BaseException:
+            # On Ctrl-C or an error, drop the queued downloads instead of waiting for all of them on exit
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
     df = pd.merge(df, df_paths, left_index=True, right_index=True)
     
     if args.csv_filepath:
@@ -389,7 +487,6 @@ def analyze_data(args):
         if user_input == 'yes':
             shutil.rmtree(figures_dir)
             print(f"Removed existing directory {figures_dir}.")
-            os.makedirs(figures_dir, exist_ok=True)
         else:
             print("Operation aborted.")
             return
@@ -397,10 +494,23 @@ def analyze_data(args):
     print(f"Created directory {figures_dir}.")
 
     # Extract videos metadata
-    csv_metadata_filename = os.path.join(args.dgs_path, "dgs_korpus_metadata.csv")
-    df = pd.read_csv(args.csv_filepath if args.csv_filepath else os.path.join(args.dgs_path, args.csv_filename), header=[0, 1], index_col=0)
-    tqdm.pandas(desc="Extracting metadata")
-    df_metadata = df["Paths"].progress_apply(extract_metadata, axis=1)
+    csv_metadata_filename = os.path.join(args.dgs_path, "dgs_korpus_metadata.csv.zst")
+    # The compression of the CSV files is inferred from their extension, both when writing and reading
+    if args.csv_filepath:
+        csv_filename = args.csv_filepath
+    else:
+        csv_filename = os.path.join(args.dgs_path, args.csv_filename)
+        # Corpora downloaded before the paths file was compressed have an uncompressed .csv
+        if not os.path.exists(csv_filename) and csv_filename.endswith('.zst') and os.path.exists(csv_filename[:-len('.zst')]):
+            csv_filename = csv_filename[:-len('.zst')]
+    df = pd.read_csv(csv_filename, header=[0, 1], index_col=0)
+    # Every ffprobe call spawns a subprocess, so run the rows in a pool of processes
+    rows = df["Paths"].to_dict("index")
+    with ProcessPoolExecutor(max_workers=args.metadata_workers) as executor:
+        extract = functools.partial(extract_metadata, cache_dir=os.path.join(args.dgs_path, ".ffprobe_cache"))
+        metadata = list(tqdm(executor.map(extract, rows.values(), chunksize=16), total=len(rows), desc="Extracting metadata"))
+    # Rows without any video metadata are dropped by from_dict, reindex keeps them with empty columns
+    df_metadata = pd.DataFrame.from_dict(dict(zip(rows, metadata)), orient='index').reindex(df.index)
     df = pd.merge(df, df_metadata, left_index=True, right_index=True)
     df.to_csv(csv_metadata_filename)
     print(f"DataFrame saved as {csv_metadata_filename}")
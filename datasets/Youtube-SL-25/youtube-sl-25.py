@@ -4,25 +4,29 @@
 import argparse
 import csv
 import os
-import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 
 import requests
 from pytube import YouTube
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+# Characters that are not allowed in filenames
+SANITIZE_TABLE = str.maketrans('', '', '\\/*?:"<>|')
 
 
 def read_csv(file_path):
     """
-    Read the CSV file and return a list of tuples containing video IDs and subdirectory names.
+    Read the CSV file lazily, yielding the rows containing video IDs and subdirectory names.
 
     :param file_path: Path to the CSV file.
-    :return: List of tuples (video_id, subdirectory_name).
+    :return: Iterator of rows [video_id, subdirectory_name].
     """
     with open(file_path, mode='r') as file:
-        reader = csv.reader(file)
-        video_data = list(reader)
-    return video_data
+        yield from csv.reader(file)
 
 def create_directory(directory_name):
     """
@@ -30,27 +34,28 @@ def create_directory(directory_name):
 
     :param directory_name: Name of the directory to create.
     """
-    if not os.path.exists(directory_name):
-        os.makedirs(directory_name)
+    os.makedirs(directory_name, exist_ok=True)
 
-def download_video(video_id, directory_name):
+def download_video(video_id, directory_name, verbose=True):
     """
     Download a YouTube video by its ID and save it to the specified directory.
 
     :param video_id: YouTube video ID.
     :param directory_name: Directory where the video will be saved.
+    :param verbose: Whether to report successful downloads.
     """
     try:
         url = f"https://www.youtube.com/watch?v={video_id}"
         yt = YouTube(url)
         stream = yt.streams.get_highest_resolution()
         # Sanitize the title to be used in filenames
-        title = re.sub(r'[\\/*?:"<>|]', "", yt.title)
+        title = yt.title.translate(SANITIZE_TABLE)
         filename = f"{video_id}_{title}.mp4"
         stream.download(output_path=directory_name, filename=filename)
-        print(f"Downloaded {filename} to {directory_name}")
+        if verbose:
+            tqdm.write(f"Downloaded {filename} to {directory_name}")
     except Exception as e:
-        print(f"Failed to download {video_id}: {e}")
+        tqdm.write(f"Failed to download {video_id}: {e}")
 
 def download_csv_from_url(url, output_dir, verify):
     """
@@ -61,13 +66,16 @@ def download_csv_from_url(url, output_dir, verify):
     :param verify: Path to CA_BUNDLE file or directory with certificates of trusted CAs
     :return: Path to the downloaded CSV file.
     """
-    response = requests.get(url, verify=verify)
-    response.raise_for_status()  # Raise an error for bad status codes
     parsed_url = urlparse(url)
     file_name = os.path.basename(parsed_url.path)
     file_path = os.path.join(output_dir, file_name)
-    with open(file_path, 'wb') as file:
-        file.write(response.content)
+    with requests.Session() as session:
+        session.mount('https://', HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.5)))
+        with session.get(url, stream=True, verify=verify, timeout=30) as response:
+            response.raise_for_status()  # Raise an error for bad status codes
+            response.raw.decode_content = True
+            with open(file_path, 'wb') as file:
+                shutil.copyfileobj(response.raw, file, length=1024 * 1024)
     return file_path
 
 def parse_arguments():
@@ -83,6 +91,7 @@ def parse_arguments():
     parser.add_argument('--languages', type=str, nargs='+', help='List of languages to download videos for.')
     parser.add_argument('--replace', type=str, choices=['all', 'skip', 'custom'], default='custom', help='Option to replace, skip, or ask for each existing subdirectory.')
     parser.add_argument('--ca_cert', type=lambda x: x if x.lower() not in ['true', 'false'] else x.lower() == 'true', default=True, help='Path to the CA certificate or a boolean to bypass SSL verification.')
+    parser.add_argument('--workers', type=int, default=8, help='Number of videos downloaded concurrently.')
     return parser.parse_args()
 
 def handle_existing_directory(directory_name, replace_option):
@@ -94,7 +103,7 @@ def handle_existing_directory(directory_name, replace_option):
     :return: Boolean indicating whether to proceed with downloading.
     """
     if replace_option == 'all':
-        os.system(f"rm -rf {directory_name}")
+        shutil.rmtree(directory_name, ignore_errors=True)
         create_directory(directory_name)
         return True
     elif replace_option == 'skip':
@@ -102,7 +111,7 @@ def handle_existing_directory(directory_name, replace_option):
     elif replace_option == 'custom':
         choice = input(f"Directory {directory_name} already exists. Do you want to replace it? (y/n): ").strip().lower()
         if choice == 'y':
-            os.system(f"rm -rf {directory_name}")
+            shutil.rmtree(directory_name, ignore_errors=True)
             create_directory(directory_name)
             return True
         else:
@@ -120,15 +129,15 @@ def main():
     else:
         csv_file_path = args.csv_file
 
-    video_data = read_csv(csv_file_path)
-    if args.languages:
-        video_data = [video for video in video_data if video[1] in args.languages]
-
-    languages = set([video[1] for video in video_data])
+    # Group the videos by language while reading, keeping only the requested languages
+    videos_by_language = {}
+    for video in read_csv(csv_file_path):
+        if not args.languages or video[1] in args.languages:
+            videos_by_language.setdefault(video[1], []).append(video)
+    total_videos = sum(len(lang_videos) for lang_videos in videos_by_language.values())
     
-    with tqdm(total=len(video_data), desc="Total Progress") as total_pbar:
-        for language in languages:
-            lang_videos = [video for video in video_data if video[1] == language]
+    with tqdm(total=total_videos, desc="Total Progress") as total_pbar:
+        for language, lang_videos in videos_by_language.items():
             lang_dir = os.path.join(args.output_dir, language)
 
             if os.path.exists(lang_dir):
@@ -139,11 +148,18 @@ def main():
             else:
                 create_directory(lang_dir)
             
-            with tqdm(total=len(lang_videos), desc=f"Downloading videos for {language}") as lang_pbar:
-                for video_id, _ in lang_videos:
-                    download_video(video_id, lang_dir)
-                    lang_pbar.update(1)
-                    total_pbar.update(1)
+            with tqdm(total=len(lang_videos), desc=f"Downloading videos for {language}") as lang_pbar, \
+                    ThreadPoolExecutor(max_workers=args.workers) as executor:
+                try:
+                    # Only report failures when downloading concurrently, the progress bars show the rest
+                    futures = [executor.submit(download_video, video_id, lang_dir, args.workers == 1) for video_id, _ in lang_videos]
+                    for _ in as_completed(futures):
+                        lang_pbar.update(1)
+                        total_pbar.update(1)
+                except BaseException:
+                    # On Ctrl-C or an error, drop the queued videos instead of waiting for all of them on exit
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,48 @@
+"""
+Frames reused between the pose files drawn by poses_to_videos.py.
+
+These caches live in their own module so that worker processes import them once and keep them
+between files. Functions of a script run as __main__ are pickled by value for each task,
+together with the globals they use, which would give every file a fresh cache.
+"""
+import functools
+import math
+import threading
+
+import numpy as np
+
+frame_buffer = threading.local()
+
+
+@functools.lru_cache(maxsize=8)
+def get_background(height, width, background_color):
+    """
+    Get a plain background frame, shared between the files with the same dimensions.
+
+    Args:
+        height (int): Height of the frame.
+        width (int): Width of the frame.
+        background_color (tuple): Color of the background.
+
+    Returns:
+        np.ndarray: Read-only frame of shape (height, width, len(background_color)).
+    """
+    background = np.full((height, width, len(background_color)), fill_value=background_color, dtype="uint8")
+    background.flags.writeable = False
+    return background
+
+def get_frame_buffer(shape):
+    """
+    Get a frame buffer of the thread, reallocated only when a larger frame is needed.
+
+    Args:
+        shape (tuple): Shape of the frame (height, width, channels).
+
+    Returns:
+        np.ndarray: Frame buffer of the requested shape, with undefined contents.
+    """
+    size = math.prod(shape)
+    buffer = getattr(frame_buffer, "array", None)
+    if buffer is None or buffer.size < size:
+        buffer = frame_buffer.array = np.empty(size, dtype="uint8")
+    return buffer[:size].reshape(shape)
@@ -1,9 +1,13 @@
 import argparse
+import mmap
 import os
 import sys
 
 from pose_format import Pose
+from pose_format.numpy import NumPyPoseBody
+from pose_format.pose_header import PoseHeader
 from pose_format.pose_visualizer import PoseVisualizer
+from pose_format.utils.reader import BufferReader
 
 
 def parse_arguments():
@@ -52,9 +56,13 @@ def read_pose_file(pose_file):
         Pose: The Pose object read from the file.
     """
     try:
-        with open(pose_file, "rb") as f:
-            pose = Pose.read(f.read())
-        return pose
+        # Map the file and parse the map directly, Pose.read would first copy anything but bytes into a new bytes object
+        # The parsed arrays are copies, so the map can be closed once the pose is read
+        with open(pose_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            reader = BufferReader(buffer)
+            header = PoseHeader.read(reader)
+            body = NumPyPoseBody.read(header, reader)
+        return Pose(header, body)
     except Exception as e:
         print(f"Error reading pose file: {e}")
         return None
@@ -1,11 +1,202 @@
 import argparse
+import itertools
+import logging
+import logging.handlers
+import math
+import mmap
 import os
+import queue
 
-from joblib import Parallel, delayed
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
 from pose_format import Pose
+from pose_format.numpy import NumPyPoseBody
+from pose_format.pose_header import PoseHeader
 from pose_format.pose_visualizer import PoseVisualizer
+from pose_format.utils.reader import BufferReader
 from tqdm import tqdm
 
+from frame_cache import get_background, get_frame_buffer
+
+logger = logging.getLogger(__name__)
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class PoseVideoVisualizer(PoseVisualizer):
+    """
+    PoseVisualizer for drawing many pose files to videos.
+
+    draw reuses the plain background between files with the same header dimensions, resolves the
+    drawing operations of a chunk of frames at once and can draw into a reused frame buffer.
+    to_grayscale converts the drawn frames to a single channel, and save_video accepts extra
+    ffmpeg output parameters.
+    """
+
+    # Frames whose operations are planned together, which bounds the memory of the plan for long clips
+    chunk_size = 256
+
+    def _list_operations(self, n_people):
+        """
+        List the drawing operations of a frame, in the order upstream draws them.
+
+        Args:
+            n_people (int): Number of people in the pose.
+
+        Returns:
+            tuple: Arrays (kind, person, first point, second point), with one entry per operation.
+                The kind is 0 for a point, drawn at its first point, and 1 for a limb.
+        """
+        # Per person and component, the points then the limbs
+        kinds, people, first, second = [], [], [], []
+        for p in range(n_people):
+            offset = 0
+            for component, palette, limbs, n in self._components:
+                points = np.arange(offset, offset + n, dtype=np.int32)
+                kinds.append(np.zeros(n, dtype=np.int32))
+                people.append(np.full(n, p, dtype=np.int32))
+                first.append(points)
+                second.append(points)
+                kinds.append(np.ones(len(limbs), dtype=np.int32))
+                people.append(np.full(len(limbs), p, dtype=np.int32))
+                first.append((limbs[:, 0] + offset).astype(np.int32))
+                second.append((limbs[:, 1] + offset).astype(np.int32))
+                offset += n
+        # A pose without people has no operations, and np.concatenate needs at least one array
+        return tuple(np.concatenate(a) if a else np.empty(0, dtype=np.int32) for a in (kinds, people, first, second))
+
+    def _plan_operations(self, data, confidence, background_color, operations):
+        """
+        Resolve the drawing operations of a chunk of frames at once.
+
+        Args:
+            data (np.ndarray): Pose data of shape (frames, people, points, dims).
+            confidence (np.ndarray): Confidence of shape (frames, people, points).
+            background_color (tuple): Color of the background, to blend the low-confidence points into.
+            operations (tuple): Operations of a frame, from _list_operations.
+
+        Returns:
+            tuple: Per-frame arrays (z, visible, pt1, pt2, color), with one column per operation.
+        """
+        kinds, people, first, second = operations
+
+        palette = np.concatenate([palette[np.arange(n) % len(palette)] for _, palette, _, n in self._components])
+        opacity = confidence[..., None]
+        # Blended in double precision like upstream, the truncated colors then fit in int32
+        colors = (palette * opacity + (1 - opacity) * np.asarray(background_color, dtype=float)).astype(np.int32)
+
+        xy = np.round(data[..., :2]).astype(np.int32)
+        # Depths are averaged in double precision like upstream, float32 could reorder operations of close depths
+        z = data[..., 2].astype(float) if data.shape[-1] > 2 else np.zeros(data.shape[:-1])
+        visible = confidence > 0
+
+        return (
+            (z[:, people, first] + z[:, people, second]) / 2,
+            visible[:, people, first] & visible[:, people, second],
+            xy[:, people, first],
+            xy[:, people, second],
+            # Points keep their integer color, limbs take the average of their two points, exact in float32
+            np.where((kinds == 0)[:, None], colors[:, people, first],
+                     (colors[:, people, first] + colors[:, people, second]) / np.float32(2)).astype(np.float32),
+        )
+
+    def draw(self, background_color=(255, 255, 255), max_frames=None, out=None):
+        """
+        Draw the pose on a plain background.
+
+        Args:
+            background_color (tuple): Color of the background.
+            max_frames (int): Maximum number of frames to draw, all frames if None.
+            out (np.ndarray): Buffer to draw every frame into, a new frame per frame if None.
+                Each yielded frame is then overwritten by the next one.
+
+        Yields:
+            np.ndarray: Frames with the pose drawn on the background.
+        """
+        dimensions = self.pose.header.dimensions
+        background = get_background(dimensions.height, dimensions.width, tuple(background_color))
+
+        def new_frame():
+            if out is None:
+                return background.copy()
+            np.copyto(out, background)
+            return out
+
+        if self.pose.header.is_bbox:
+            for frame, confidence in itertools.islice(zip(self.pose.body.data, self.pose.body.confidence), max_frames):
+                yield self._draw_frame(frame, confidence, img=new_frame())
+            return
+
+        thickness = self.thickness
+        if thickness is None:
+            thickness = round(math.sqrt(dimensions.height * dimensions.width) / 150)
+        radius = math.ceil(thickness / 2)
+
+        # Rounding, blending and visibility are computed for a chunk of frames at once, leaving only the cv2 calls per frame
+        data = np.asarray(self.pose.body.data[:max_frames])
+        confidence = np.asarray(self.pose.body.confidence[:max_frames])
+        operations = self._list_operations(data.shape[1])
+        kinds = operations[0]
+
+        for start in range(0, len(data), self.chunk_size):
+            end = start + self.chunk_size
+            z, visible, pt1, pt2, colors = self._plan_operations(data[start:end], confidence[start:end],
+                                                                 background_color, operations)
+            for t in range(len(z)):
+                selected = np.flatnonzero(visible[t])
+                # Painter's algorithm, far operations first, in a stable order like upstream
+                order = selected[np.argsort(-z[t, selected], kind="stable")]
+                img = new_frame()
+                for kind, a, b, color in zip(kinds[order].tolist(), pt1[t, order].tolist(),
+                                             pt2[t, order].tolist(), colors[t, order].tolist()):
+                    if kind == 0:
+                        self.cv2.circle(img, a, radius, color, thickness=-1, lineType=16)
+                    else:
+                        self.cv2.line(img, a, b, color, thickness=thickness, lineType=self.cv2.LINE_AA)
+                yield img
+
+    def to_grayscale(self, frames):
+        """
+        Convert the drawn frames to single-channel frames.
+
+        Args:
+            frames (Iterable[np.ndarray]): BGR frames, e.g. from draw.
+
+        Yields:
+            np.ndarray: Grayscale frame, overwritten by the next one.
+        """
+        gray = None
+        for frame in frames:
+            gray = self.cv2.cvtColor(frame, self.cv2.COLOR_BGR2GRAY, dst=gray)
+            yield gray
+
+    def save_video(self, f_name, frames, custom_ffmpeg=None, output_params=None):
+        """
+        Save the pose frames as an H.264 video.
+
+        Args:
+            f_name (str): Path to the output video file.
+            frames (Iterable[np.ndarray]): Frames to encode.
+            custom_ffmpeg (str): Path to a custom ffmpeg executable.
+            output_params (dict): ffmpeg parameters added to or overriding the defaults, e.g. {"-threads": 4}.
+        """
+        from vidgear.gears import WriteGear
+
+        params = {"-vcodec": "libx264", "-preset": "fast", "-input_framerate": self.pose.body.fps}
+        params.update(output_params or {})
+
+        writer = None
+        for frame in frames:
+            if writer is None:  # Create the writer on the first frame, once its shape is known
+                if frame.shape[0] % 2 == 0 and frame.shape[1] % 2 == 0:
+                    params.setdefault("-pix_fmt", "yuv420p")
+                else:
+                    logger.warning(f"Video shape {frame.shape[:2]} of {f_name} is not divisible by 2. Can not use H.264. "
+                                   "Consider resizing to a divisible shape.")
+                writer = WriteGear(output=f_name, logging=False, custom_ffmpeg=custom_ffmpeg, **params)
+            writer.write(frame)
+
+        if writer is not None:
+            writer.close()
 
 def parse_arguments():
     """
@@ -19,32 +210,38 @@ def parse_arguments():
     parser.add_argument('--output_dir', type=str, required=True, help='Directory to save the output video files.')
     parser.add_argument('--replace', type=str, choices=['True', 'False', 'ask'], default='ask', help='Replace existing files: True, False, or ask.')
     parser.add_argument('--n_jobs', type=int, default=1, help='Number of CPU cores to use for parallel processing.')
+    parser.add_argument('--backend', type=str, choices=['threads', 'processes'], default='threads', help='Run the parallel jobs in threads or in processes.')
+    parser.add_argument('--encoder_threads', type=int, default=None, help='Number of ffmpeg threads per video (defaults to the CPU cores divided by n_jobs).')
+    parser.add_argument('--grayscale', action='store_true', help='Save grayscale videos, which encode faster than the colored skeletons.')
+    parser.add_argument('--log_level', type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='WARNING', help='Logging level, INFO reports every saved or skipped video.')
+    parser.add_argument('--encoder_preset', type=str, default='ultrafast', help='x264 preset of the encoder, from ultrafast to veryslow.')
     return parser.parse_args()
 
-def check_output_file(output_video_path, replace_option):
+def check_output_file(output_video_path, replace_option, output_exists):
     """
     Check the output file based on the replace option.
 
     Args:
         output_video_path (str): Path to the output video file.
         replace_option (str): Replace option ('True', 'False', or 'ask').
+        output_exists (bool): Whether the output video file already exists.
 
     Returns:
         bool: True if the file can be written, False otherwise.
     """
-    if os.path.exists(output_video_path):
+    if output_exists:
         if replace_option == 'true':
-            print(f"Output file {output_video_path} exists. Overwriting because --replace is set to True.")
+            logger.info(f"Output file {output_video_path} exists. Overwriting because --replace is set to True.")
             return True
         elif replace_option == 'ask':
             response = input(f"Output file {output_video_path} exists. Do you want to overwrite it? (y/n): ").strip().lower()
             if response != 'y':
-                print("File will not be overwritten. Exiting.")
+                logger.info("File will not be overwritten, skipping it.")
                 return False
-            print("File will be overwritten.")
+            logger.info("File will be overwritten.")
             return True
         else:
-            print(f"Output file {output_video_path} exists. Not changing it because --replace is set to False.")
+            logger.info(f"Output file {output_video_path} exists. Not changing it because --replace is set to False.")
             return False
     return True
 
@@ -59,72 +256,243 @@ def read_pose_file(pose_file):
         Pose: The Pose object read from the file.
     """
     try:
-        with open(pose_file, "rb") as f:
-            pose = Pose.read(f.read())
-        return pose
+        # Map the file instead of reading it into a bytes copy, the OS pages it in as it is parsed
+        # The parsed arrays are copies, so the map can be closed once the pose is read
+        with open(pose_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            # Pose.read would copy anything but bytes into a new bytes object first, the reader parses the map directly
+            reader = BufferReader(buffer)
+            header = PoseHeader.read(reader)
+            body = NumPyPoseBody.read(header, reader)
+        return Pose(header, body)
     except Exception as e:
-        print(f"Error reading pose file {pose_file}: {e}")
+        logger.error(f"Error reading pose file {pose_file}: {e}")
         return None
 
-def save_pose_video(pose, output_video_path):
+def save_pose_video(pose, output_video_path, output_params=None, grayscale=False):
     """
     Save the pose data as a video file.
 
     Args:
         pose (Pose): The Pose object to visualize and save.
         output_video_path (str): Path to save the output video file.
+        output_params (dict): Additional ffmpeg output parameters.
+        grayscale (bool): Whether to pass single-channel frames to the encoder.
     """
     try:
-        v = PoseVisualizer(pose)
-        v.save_video(output_video_path, v.draw())
-        print(f"Video saved successfully to {output_video_path}")
+        v = PoseVideoVisualizer(pose)
+        # The encoder consumes each frame before the next one is drawn, so one buffer per thread is enough
+        dimensions = pose.header.dimensions
+        out = get_frame_buffer((dimensions.height, dimensions.width, 3))
+        frames = v.draw(out=out)
+        if grayscale:
+            # A third of the bytes piped to ffmpeg, which reads one gray plane instead of three
+            frames = v.to_grayscale(frames)
+        v.save_video(output_video_path, frames, output_params=output_params)
+        logger.info(f"Video saved successfully to {output_video_path}")
     except ImportError as e:
-        print(f"Error: {e}. Please ensure that vidgear is installed.")
-        print("You can install it using: pip install vidgear")
+        logger.error(f"Error: {e}. Please ensure that vidgear is installed. You can install it using: pip install vidgear")
     except Exception as e:
-        print(f"Error saving video {output_video_path}: {e}")
+        logger.error(f"Error saving video {output_video_path}: {e}")
 
-def process_file(pose_file, input_dir, output_dir, replace_option):
+def iter_pose_files(directory):
     """
-    Process a single pose file to create a video.
+    Recursively yield the .pose files of a directory.
+
+    Args:
+        directory (str): Path to the directory to search.
+
+    Yields:
+        os.DirEntry: Entry of a .pose file.
+    """
+    try:
+        entries = os.scandir(directory)
+    except OSError as e:
+        # Unreadable directories are skipped like os.walk does, but reported
+        logger.warning(f"Skipping directory {directory}: {e}")
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_pose_files(entry.path)
+            elif entry.name.endswith('.pose'):
+                yield entry
+
+def get_file_size(entry):
+    """
+    Get the size of a pose file, following symbolic links.
+
+    Args:
+        entry (os.DirEntry): Entry of the pose file.
+
+    Returns:
+        int: Size of the file, or 0 if it cannot be read, e.g. a broken link.
+    """
+    try:
+        return entry.stat().st_size
+    except OSError:
+        return 0
+
+def prefetch_file(path):
+    """
+    Ask the OS to start reading a file into the page cache in the background.
+
+    Args:
+        path (str): Path to the file to prefetch.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def prefetch_files(pose_files):
+    """
+    Yield the pose files, prefetching each one as it is yielded.
+
+    Parallel only pulls the tasks it pre-dispatches from its input, so the files queued
+    for the workers are read from disk while the workers encode the previous ones.
+
+    Args:
+        pose_files (list): Paths to the input .pose files.
+
+    Yields:
+        str: Path to the next input .pose file.
+    """
+    for pose_file in pose_files:
+        prefetch_file(pose_file)
+        yield pose_file
+
+def get_output_video_path(pose_file, input_dir, output_dir):
+    """
+    Get the path of the video created for a pose file, mirroring the input directory tree.
 
     Args:
         pose_file (str): Path to the input .pose file.
         input_dir (str): Path to the input directory.
         output_dir (str): Path to the output directory.
-        replace_option (str): Replace option ('True', 'False', or 'ask').
+
+    Returns:
+        str: Path to the output video file.
     """
     relative_path = os.path.relpath(pose_file, input_dir)
-    output_video_path = os.path.join(output_dir, os.path.splitext(relative_path)[0] + ".mp4")
-    os.makedirs(os.path.dirname(output_video_path), exist_ok=True)
+    return os.path.join(output_dir, os.path.splitext(relative_path)[0] + ".mp4")
 
-    if not check_output_file(output_video_path, replace_option):
-        return
+def process_file(pose_file, input_dir, output_dir, output_params=None, grayscale=False, log_level='WARNING'):
+    """
+    Process a single pose file to create a video.
+
+    This is the unit of work sent to the workers. It takes the path of the pose file and reads the file
+    itself, so that only small arguments are pickled for the process backend and never the decoded Pose.
+    Whether its video may be written is decided in the main process before it is dispatched.
+
+    Args:
+        pose_file (str): Path to the input .pose file.
+        input_dir (str): Path to the input directory.
+        output_dir (str): Path to the output directory.
+        output_params (dict): Additional ffmpeg output parameters.
+        grayscale (bool): Whether to save the video in grayscale.
+        log_level (str): Logging level of the worker processes.
+    """
+    # Worker processes do not inherit the logging setup of main, configure them on their first file
+    # In threads (and in main) the root logger already has its queue handler, so this does nothing
+    logging.basicConfig(level=log_level, format=LOG_FORMAT)
+
+    if not isinstance(pose_file, (str, os.PathLike)):
+        raise TypeError(f"process_file expects the path of a pose file, got {type(pose_file).__name__}.")
+
+    output_video_path = get_output_video_path(pose_file, input_dir, output_dir)
 
     pose = read_pose_file(pose_file)
     if pose is None:
         return
 
-    save_pose_video(pose, output_video_path)
+    save_pose_video(pose, output_video_path, output_params, grayscale)
 
-def main():
-    """
-    Main function to visualize poses from .pose files in a directory and save as videos.
+def run(args, parallel):
     """
-    args = parse_arguments()
+    Visualize the poses of the input directory and save them as videos.
 
+    Args:
+        args (argparse.Namespace): Parsed command-line arguments.
+        parallel (Parallel): Parallel instance to dispatch the files to, whose workers are reused between calls.
+    """
     input_dir = args.input_dir
     output_dir = args.output_dir
     replace_option = args.replace.lower()
-    n_jobs = args.n_jobs
 
-    pose_files = [os.path.join(dp, f) for dp, dn, filenames in os.walk(input_dir) for f in filenames if os.path.splitext(f)[1] == '.pose']
+    if not os.path.isdir(input_dir):
+        logger.error(f"Input directory {input_dir} does not exist or is not a directory.")
+        return
+
+    # Split the cores between the jobs, each ffmpeg encoder using its share
+    encoder_threads = args.encoder_threads or max(1, (os.cpu_count() or 1) // effective_n_jobs(args.n_jobs))
+    output_params = {"-threads": encoder_threads, "-preset": args.encoder_preset}
+
+    # Largest files first, so that long clips do not start last and leave the other workers idle at the end
+    pose_entries = sorted(iter_pose_files(input_dir), key=get_file_size, reverse=True)
+    pose_files = [entry.path for entry in pose_entries]
+    output_paths = {pose_file: get_output_video_path(pose_file, input_dir, output_dir) for pose_file in pose_files}
 
-    with tqdm(total=len(pose_files), desc="Processing Videos") as pbar:
-        Parallel(n_jobs=n_jobs)(
-            delayed(lambda pf: (process_file(pf, input_dir, output_dir, replace_option), pbar.update()))(pose_file)
-            for pose_file in pose_files
+    # Create the output directory tree once instead of once per file
+    output_dirs = {os.path.dirname(output_video_path) for output_video_path in output_paths.values()}
+    for directory in output_dirs:
+        os.makedirs(directory, exist_ok=True)
+
+    # List the existing videos in a single walk of the output directory instead of a stat per file
+    existing_outputs = {os.path.normpath(os.path.join(dp, f)) for dp, dn, filenames in os.walk(output_dir) for f in filenames if f.endswith('.mp4')}
+
+    # Files whose video is not to be written are dropped here rather than dispatched to a worker
+    if replace_option == 'false':
+        n_files = len(pose_files)
+        pose_files = [pose_file for pose_file in pose_files if os.path.normpath(output_paths[pose_file]) not in existing_outputs]
+        if len(pose_files) < n_files:
+            logger.info(f"Skipping {n_files - len(pose_files)} files whose output exists because --replace is set to False.")
+    else:
+        # With --replace ask, the questions are asked one at a time here, before any worker starts
+        pose_files = [
+            pose_file for pose_file in pose_files
+            if check_output_file(output_paths[pose_file], replace_option, os.path.normpath(output_paths[pose_file]) in existing_outputs)
+        ]
+    if not pose_files:
+        return
+
+    # Advance the progress bar in the main process as the files complete, in whatever order
+    # Only paths and options are dispatched, the workers read and draw the poses themselves
+    results = parallel(
+        delayed(process_file)(
+            pose_file, input_dir, output_dir, output_params, args.grayscale, args.log_level,
         )
+        for pose_file in prefetch_files(pose_files)
+    )
+    for _ in tqdm(results, total=len(pose_files), desc="Processing Videos"):
+        pass
+
+def main():
+    """
+    Main function to visualize poses from .pose files in a directory and save as videos.
+    """
+    args = parse_arguments()
+
+    # Workers hand their records to a queue and return, a single listener thread writes them to stderr
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    logging.basicConfig(level=args.log_level, format=LOG_FORMAT,
+                        handlers=[logging.handlers.QueueHandler(log_queue)])
+    listener.start()
+    try:
+        # Drawing (OpenCV) and encoding (ffmpeg) mostly run outside the GIL, so threads avoid spawning
+        # and pickling for processes; processes remain available if the drawing turns out GIL-bound
+        # One file per batch keeps the largest-first order, each worker pulling the next largest file when it is free
+        # The workers are started once for the whole block and shut down when it exits
+        with Parallel(n_jobs=args.n_jobs, prefer=args.backend, batch_size=1, return_as="generator_unordered") as parallel:
+            run(args, parallel)
+    finally:
+        listener.stop()
 
 if __name__ == '__main__':
     main()